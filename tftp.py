@@ -1,291 +1,726 @@
-# task-specific custom tftp client library
-# to avoid tftpy dependency
-
-from enum import IntEnum
-import socket
-import struct
-import time
-import logging
-
-# codes
-class Opcode(IntEnum):
-    RRQ = 1
-    WRQ = 2
-    DATA = 3
-    ACK = 4
-    ERR = 5
-    OACK = 6
-
-class Errcode(IntEnum):
-    CUSTOM = 0
-    FILE_NOT_FOUND = 1
-    ACCESS_VIOLATION = 2
-    DISK_FULL = 3
-    ILLEGAL_OPERATION = 4
-    UNKNOWN_TID = 5
-    FILE_ALREADY_EXISTS = 6
-    NO_SUCH_USER = 7
-    NO_OPTIONS_ERROR = 8
-
-
-class TFTPClientError(Exception):
-    pass
-
-class TFTPClientCustomError(TFTPClientError):
-    pass
-
-class TFTPClientFileNotFoundError(TFTPClientError):
-    pass
-
-class TFTPClientAccessViolationError(TFTPClientError):
-    pass
-
-class TFTPClientDiskFullError(TFTPClientError):
-    pass
-
-class TFTPClientIllegalOperationError(TFTPClientError):
-    pass
-
-
-# handy utils
-
-def cstr(s):
-    return bytes(s, 'ascii') + b'\0'
-
-def create_data_pkt(blocknum, data):
-    return struct.pack('! H H', Opcode.DATA, blocknum) + data
-
-def create_ack_pkt(acknum):
-    return struct.pack('! H H', Opcode.ACK, acknum)
-
-def create_err_pkt(errcode, msg=''):
-    return struct.pack('! H H s', Opcode.ERR, errcode, cstr(msg))
-
-def create_rq_pkt(filename, op, options=None):
-    pkt = struct.pack('! H', op) + cstr(filename) + cstr('octet')
-    if options:
-        pkt += b''.join([cstr(k) + cstr(v) for k, v in options.items()])
-    return pkt
-
-def create_wrq_pkt(filename, blocksize, timeout):
-    return create_rq_pkt(filename, Opcode.WRQ, {'blksize':str(blocksize), 'timeout':str(timeout)})
-
-def create_rrq_pkt(filename, blocksize, timeout):
-    return create_rq_pkt(filename, Opcode.RRQ, {'blksize':str(blocksize), 'timeout':str(timeout)})
-
-
-# the options are kv pairs, each word is \0 terminated
-def parse_options(src):
-    src = str(src, 'ascii')
-    words = src.strip().split('\0')
-    options = {k.lower():v for k, v in zip(words[0::2], words[1::2])}
-    return options
-
-
-# NOTE: call to parse should be wrapped in try block
-def parse_pkt(src):
-    op, = struct.unpack_from('! H', src)
-    if op == Opcode.DATA:
-        blocknum, = struct.unpack_from('! H', src, 2)
-        return {'op': Opcode.DATA, 'blocknum': blocknum, 'data': src[4:]}
-    elif op == Opcode.ACK:
-        acknum, = struct.unpack_from('! H', src, 2)
-        return {'op': Opcode.ACK, 'acknum': acknum}
-    elif op == Opcode.ERR:
-        errcode, = struct.unpack_from('! H', src, 2)
-        return {'op': Opcode.ERR, 'errcode': errcode, 'msg': str(src[4:], 'ascii').rstrip('\0')}
-    elif op == Opcode.OACK:
-        options = parse_options(src[2:])
-        return {'op': Opcode.OACK, 'options': options}
-    else:
-        return {'op': op}
-
-
-class TFTPClient:
-    def __init__(self, ip, port, timeout=1, connect_timeout=10, session_timeout=10, blocksize=1468):
-        self.sock = None
-        self.connect_timeout = connect_timeout
-        self.session_timeout = session_timeout
-        self.def_timeout = timeout
-        self.def_blocksize = blocksize
-        self.ip = ip
-        self.connect_port = port
-        self.port = None
-
-
-    def txrx(self, tx, handle_rx, timeout):
-        sock = self.sock
-        sock.settimeout(self.timeout)
-        start = time.time()
-        while True:
-            now = time.time()
-            if now - start > timeout:
-                raise TFTPClientError('timeout')
-
-            sock.sendto(tx, (self.ip, self.port))
-
-            rxstart = time.time()
-            try:
-                data, remote = sock.recvfrom(2048)
-            except socket.timeout:
-                continue
-            rxend = time.time()
-
-            try:
-                rx = parse_pkt(data)
-            except:
-                logging.exception('parse error')
-            else:
-                if remote[0] == self.ip:
-                    resp = handle_rx(rx)
-                    if resp:
-                        return resp, remote
-            # sleep more, avoid resend if woke up prematurely
-            time.sleep(max(rxstart + self.timeout - rxend, 0))
-
-
-    def process_generic_err(self, rx):
-        if rx['op'] == Opcode.ERR:
-            errcode = rx['errcode']
-            msg = rx['msg']
-            if errcode == Errcode.ACCESS_VIOLATION:
-                raise TFTPClientAccessViolationError(msg)
-            elif errcode == Errcode.CUSTOM:
-                raise TFTPClientCustomError(msg)
-            elif errcode == Errcode.DISK_FULL:
-                raise TFTPClientDiskFullError(msg)
-            elif errcode == Errcode.FILE_NOT_FOUND:
-                raise TFTPClientFileNotFoundError(msg)
-            elif errcode == Errcode.ILLEGAL_OPERATION:
-                raise TFTPClientIllegalOperationError(msg)
-            else:
-                raise TFTPClientError('Server error %s %s' % (str(errcode), msg))
-
-    def process_unhandled(self, rx):
-        raise TFTPClientError('Unexpected packet %s' % str(rx['op']))
-
-
-    def handle_read_connect(self, rx):
-        # NOTE: in our implementation custom code most likely means 'busy'.
-        # do not bail out, just retry
-        if rx['op'] == Opcode.ERR and rx['errcode'] == Errcode.CUSTOM:
-            return None
-
-        self.process_generic_err(rx)
-        if rx['op'] == Opcode.OACK:
-            return rx
-        if rx['op'] == Opcode.DATA:
-            if rx['blocknum'] == 1:
-                return rx
-            return None
-        self.process_unhandled(rx)
-
-
-    def handle_write_connect(self, rx):
-        if rx['op'] == Opcode.ERR and rx['errcode'] == Errcode.CUSTOM:
-            return None
-
-        self.process_generic_err(rx)
-        if rx['op'] == Opcode.OACK:
-            return rx
-        if rx['op'] == Opcode.ACK:
-            if rx['blocknum'] == 0:
-                return rx
-            return None
-        self.process_unhandled(rx)
-
-
-    def handle_data_rx(self, rx):
-        self.process_generic_err(rx)
-        if rx['op'] == Opcode.DATA:
-            if rx['blocknum'] == self.blocknum + 1:
-                return rx
-            return None
-        self.process_unhandled(rx)
-
-
-    def handle_data_tx(self, rx):
-        self.process_generic_err(rx)
-        if rx['op'] == Opcode.ACK:
-            if rx['acknum'] == self.blocknum:
-                return rx
-            return None
-        self.process_unhandled(rx)
-
-
-    def setup(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.blocknum = 0
-        self.blocksize = 512
-        self.timeout = 1
-        self.port = self.connect_port
-
-
-    def accept_options(self, oack):
-        try:
-            options = oack['options']
-            if 'blksize' in options:
-                bs = int(options['blksize'])
-                if (64 <= bs <= 1468):
-                    self.blocksize = bs
-                else:
-                    raise TFTPClientError('Unacceptable blocksize %d', bs)
-            if 'timeout' in options:
-                tout = int(options['timeout'])
-                if (1 <= tout <= self.session_timeout):
-                    self.timeout = tout
-        except:
-            raise TFTPClientError('Unacceptable options')
-
-
-    def connect(self, remote):
-        self.sock.connect(remote)
-        self.port = remote[1]
-
-
-    def read(self, filename):
-        self.setup()
-
-        buf = b''
-
-        pkt = create_rrq_pkt(filename, self.def_blocksize, self.def_timeout)
-        resp, remote = self.txrx(pkt, self.handle_read_connect, self.connect_timeout)
-        if resp['op'] == Opcode.OACK:
-            self.accept_options(resp)
-        else: # data
-            self.blocknum = 1
-            buf += resp['data']
-
-        # the response may come from another port. 'connect' to it
-        self.connect(remote)
-
-        while True:
-            ack = create_ack_pkt(self.blocknum)
-            resp,remote = self.txrx(ack, self.handle_data_rx, self.session_timeout)
-            buf += resp['data']
-            self.blocknum += 1
-            if len(resp['data']) < self.blocksize:
-                ack = create_ack_pkt(self.blocknum)
-                self.sock.send(ack)
-                return buf
-
-
-    def write(self, filename, buf):
-        self.setup()
-
-        pkt = create_wrq_pkt(filename, self.def_blocksize, self.def_timeout)
-        resp, remote = self.txrx(pkt, self.handle_write_connect, self.connect_timeout)
-        if resp['op'] == Opcode.OACK:
-            self.accept_options(resp)
-
-        self.connect(remote)
-
-        while True:
-            self.blocknum += 1;
-            chunk = buf[:self.blocksize]
-            buf = buf[self.blocksize:]
-            tx = create_data_pkt(self.blocknum, chunk)
-            resp, remote = self.txrx(tx, self.handle_data_tx, self.session_timeout)
-
-            if len(chunk) < self.blocksize:
-                return
+# task-specific custom tftp client library
+# to avoid tftpy dependency
+
+from collections import namedtuple
+from enum import IntEnum
+import ctypes
+import errno
+import os
+import select
+import socket
+import struct
+import sys
+import time
+import random
+import logging
+
+# codes
+class Opcode(IntEnum):
+    RRQ = 1
+    WRQ = 2
+    DATA = 3
+    ACK = 4
+    ERR = 5
+    OACK = 6
+
+class Errcode(IntEnum):
+    CUSTOM = 0
+    FILE_NOT_FOUND = 1
+    ACCESS_VIOLATION = 2
+    DISK_FULL = 3
+    ILLEGAL_OPERATION = 4
+    UNKNOWN_TID = 5
+    FILE_ALREADY_EXISTS = 6
+    NO_SUCH_USER = 7
+    NO_OPTIONS_ERROR = 8
+
+
+class TFTPClientError(Exception):
+    pass
+
+class TFTPClientCustomError(TFTPClientError):
+    pass
+
+class TFTPClientFileNotFoundError(TFTPClientError):
+    pass
+
+class TFTPClientAccessViolationError(TFTPClientError):
+    pass
+
+class TFTPClientDiskFullError(TFTPClientError):
+    pass
+
+class TFTPClientIllegalOperationError(TFTPClientError):
+    pass
+
+
+# precompiled header formats, struct.pack/unpack with literal strings
+# pays the format lookup on every call
+_STRUCT_H = struct.Struct('! H')
+_STRUCT_HH = struct.Struct('! H H')
+
+
+# handy utils
+
+def cstr(s):
+    return bytes(s, 'ascii') + b'\0'
+
+def create_data_pkt(blocknum, data):
+    return _STRUCT_HH.pack(Opcode.DATA, blocknum) + data
+
+def create_ack_pkt(acknum):
+    return _STRUCT_HH.pack(Opcode.ACK, acknum)
+
+def create_err_pkt(errcode, msg=''):
+    return _STRUCT_HH.pack(Opcode.ERR, errcode) + cstr(msg)
+
+def create_rq_pkt(filename, op, options=None):
+    pkt = _STRUCT_H.pack(op) + cstr(filename) + cstr('octet')
+    if options:
+        pkt += b''.join([cstr(k) + cstr(v) for k, v in options.items()])
+    return pkt
+
+def create_rq_options(blocksize, timeout, windowsize):
+    options = {'blksize':str(blocksize), 'timeout':str(timeout)}
+    if windowsize > 1:
+        options['windowsize'] = str(windowsize)
+    return options
+
+def create_wrq_pkt(filename, blocksize, timeout, windowsize=1):
+    return create_rq_pkt(filename, Opcode.WRQ, create_rq_options(blocksize, timeout, windowsize))
+
+def create_rrq_pkt(filename, blocksize, timeout, windowsize=1):
+    return create_rq_pkt(filename, Opcode.RRQ, create_rq_options(blocksize, timeout, windowsize))
+
+
+# the options are kv pairs, each word is \0 terminated.
+# single pass over the bytes, no full-buffer decode or temporary lists
+def parse_options(src):
+    src = bytes(src)
+    options = {}
+    i = 0
+    while i < len(src):
+        j = src.find(b'\0', i)
+        if j < 0:
+            break
+        key = src[i:j].lower()
+        i = j + 1
+        j = src.find(b'\0', i)
+        if j < 0:
+            break
+        options[key.decode('ascii')] = src[i:j].decode('ascii')
+        i = j + 1
+    return options
+
+
+# parsed packet containers. namedtuples are much lighter to build than
+# dicts and this runs once per received packet
+DataPkt = namedtuple('DataPkt', 'op blocknum data')
+AckPkt = namedtuple('AckPkt', 'op acknum')
+ErrPkt = namedtuple('ErrPkt', 'op errcode msg')
+OackPkt = namedtuple('OackPkt', 'op options')
+Pkt = namedtuple('Pkt', 'op')
+
+
+def _parse_data(src):
+    if len(src) < 4:
+        return None
+    op, blocknum = _STRUCT_HH.unpack_from(src)
+    # src may be a view into a reused rx buffer, detach the payload
+    return DataPkt(_OP_DATA, blocknum, bytes(src[4:]))
+
+def _parse_ack(src):
+    if len(src) < 4:
+        return None
+    op, acknum = _STRUCT_HH.unpack_from(src)
+    return AckPkt(_OP_ACK, acknum)
+
+def _parse_err(src):
+    if len(src) < 4:
+        return None
+    op, errcode = _STRUCT_HH.unpack_from(src)
+    return ErrPkt(_OP_ERR, errcode, str(src[4:], 'ascii').rstrip('\0'))
+
+def _parse_oack(src):
+    return OackPkt(_OP_OACK, parse_options(src[2:]))
+
+# plain-int twins of the hot Opcode members: int.__eq__ is a C slot,
+# IntEnum.__eq__ goes through Python-level dispatch on every compare
+_OP_DATA = int(Opcode.DATA)
+_OP_ACK = int(Opcode.ACK)
+_OP_ERR = int(Opcode.ERR)
+_OP_OACK = int(Opcode.OACK)
+
+# dispatch by raw opcode, no enum compare ladder per packet
+_PARSERS = {
+    _OP_DATA: _parse_data,
+    _OP_ACK: _parse_ack,
+    _OP_ERR: _parse_err,
+    _OP_OACK: _parse_oack,
+}
+
+
+# returns None for a runt packet. a malformed ERR/OACK payload may
+# still raise on decode, so keep a narrow try block around the call
+def parse_pkt(src):
+    if len(src) < 2:
+        return None
+    op, = _STRUCT_H.unpack_from(src)
+    fn = _PARSERS.get(op)
+    return fn(src) if fn else Pkt(op)
+
+
+# sendmmsg(2) lets us push a whole window of datagrams in one syscall.
+# ctypes-only, so keep it linux-gated and fall back to a send loop
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+_libc = None
+if sys.platform == 'linux':
+    try:
+        _libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        _libc.sendmmsg
+        _libc.recvmmsg
+    except (OSError, AttributeError):
+        _libc = None
+
+# cap on datagrams drained per recvmmsg call
+_MRX_VLEN = 32
+
+
+# reusable msgvec for recvmmsg(2): drains a queued burst of datagrams
+# in one syscall instead of one recv per packet
+class _MmsgReceiver:
+    def __init__(self, vlen=_MRX_VLEN):
+        self.vlen = vlen
+        self.bufs = [bytearray(2048) for _ in range(vlen)]
+        self.views = [memoryview(buf) for buf in self.bufs]
+        self.cbufs = [(ctypes.c_char * 2048).from_buffer(buf) for buf in self.bufs]
+        self.iovs = (_iovec * vlen)()
+        self.hdrs = (_mmsghdr * vlen)()
+        for i in range(vlen):
+            self.iovs[i].iov_base = ctypes.cast(self.cbufs[i], ctypes.c_void_p)
+            self.iovs[i].iov_len = 2048
+            self.hdrs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovs[i])
+            self.hdrs[i].msg_hdr.msg_iovlen = 1
+
+    # non-blocking drain, returns views of the received payloads.
+    # the views alias the reused buffers and are valid until the next call
+    def recv(self, sock):
+        res = _libc.recvmmsg(sock.fileno(), ctypes.byref(self.hdrs[0]),
+                             self.vlen, socket.MSG_DONTWAIT, None)
+        if res < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(err, os.strerror(err))
+        hdrs = self.hdrs
+        views = self.views
+        return [views[i][:hdrs[i].msg_len] for i in range(res)]
+
+
+# send DATA blocks [base, last] of mv to the connected socket. header
+# and payload go as separate iovecs (scatter-gather), so the payload is
+# never copied out of the source buffer in user space. batched into one
+# sendmmsg syscall per window on linux, a sendmsg loop elsewhere
+def send_data_window(sock, mv, total, bs, base, last):
+    hdrs = [_STRUCT_HH.pack(_OP_DATA, bn) for bn in range(base, last + 1)]
+
+    # the address arithmetic below is relative to the backing object, so
+    # the fast path is only safe when mv covers the whole buffer: a
+    # sliced or strided view would silently send the wrong bytes
+    if (_libc is None or not isinstance(mv.obj, bytes)
+            or not mv.contiguous or mv.nbytes != len(mv.obj)):
+        # sock.sendmsg gathers the buffers in the kernel, still no copy
+        for i, bn in enumerate(range(base, last + 1)):
+            off = (bn - 1) * bs
+            sock.sendmsg((hdrs[i], mv[off:min(off + bs, total)]))
+        return
+
+    n = last - base + 1
+    bufaddr = ctypes.cast(ctypes.c_char_p(mv.obj), ctypes.c_void_p).value
+    iovs = (_iovec * (2 * n))()
+    msgs = (_mmsghdr * n)()
+    for i in range(n):
+        off = (base + i - 1) * bs
+        iovs[2 * i].iov_base = ctypes.cast(ctypes.c_char_p(hdrs[i]), ctypes.c_void_p)
+        iovs[2 * i].iov_len = 4
+        iovs[2 * i + 1].iov_base = bufaddr + off
+        iovs[2 * i + 1].iov_len = min(bs, total - off)
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[2 * i])
+        msgs[i].msg_hdr.msg_iovlen = 2
+
+    sent = 0
+    while sent < n:
+        res = _libc.sendmmsg(sock.fileno(), ctypes.byref(msgs[sent]), n - sent, 0)
+        if res < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            raise OSError(err, os.strerror(err))
+        sent += res
+
+
+# lower bound for the adaptive retransmit timeout
+_RTO_MIN = 0.05
+# retransmit jitter upper bound, desynchronizes resend storms
+_RTO_JITTER = 0.05
+
+
+class TFTPClient:
+    def __init__(self, ip, port, timeout=1, connect_timeout=10, session_timeout=10, blocksize=1468, windowsize=8, busy_poll_us=0):
+        self.sock = None
+        # spin this long before parking in select, for very low-latency links
+        self.busy_poll_us = busy_poll_us
+        self.connect_timeout = connect_timeout
+        self.session_timeout = session_timeout
+        self.def_timeout = timeout
+        self.def_blocksize = blocksize
+        self.def_windowsize = windowsize
+        # rrq/wrq tail depends only on the client config, build it once
+        options = create_rq_options(blocksize, timeout, windowsize)
+        self._rq_tail = cstr('octet') + b''.join([cstr(k) + cstr(v) for k, v in options.items()])
+        self.ip = ip
+        self.connect_port = port
+        self.port = None
+        # smoothed rtt estimate (RFC 6298 style), survives across sessions
+        # to the same server
+        self._srtt = None
+        self._rttvar = None
+        # lazily created recvmmsg state, reused across sessions
+        self._mrx = None
+
+
+    def _update_rtt(self, rtt):
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - rtt)
+            self._srtt = 0.875 * self._srtt + 0.125 * rtt
+
+
+    # retransmit after srtt + 4*rttvar instead of the full negotiated
+    # timeout: on a fast link a lost packet is resent in ~tens of ms
+    # rather than seconds. repeated losses back off linearly with a
+    # bit of jitter - constant resends storm a congested link while
+    # exponential backoff wastes time when it isn't
+    def _rto(self, retries=0):
+        if self._srtt is None:
+            rto = self.timeout
+        else:
+            rto = min(self.timeout, max(_RTO_MIN, self._srtt + 4 * self._rttvar))
+        rto = rto * (1 + 0.5 * retries) + random.uniform(0, _RTO_JITTER)
+        return min(self.session_timeout, rto)
+
+
+    # wait for a readable socket for at most timeout seconds. the socket
+    # is nonblocking, so there is no settimeout/exception round trip per
+    # packet. the optional busy-poll spin trades cpu for wakeup latency
+    def _wait_rx(self, timeout):
+        sock = self.sock
+        if self.busy_poll_us:
+            spin_end = time.monotonic_ns() + self.busy_poll_us * 1000
+            while time.monotonic_ns() < spin_end:
+                if select.select([sock], [], [], 0)[0]:
+                    return True
+        return bool(select.select([sock], [], [], timeout)[0])
+
+
+    def txrx(self, tx, handle_rx, timeout):
+        sock = self.sock
+        connected = self._connected
+        # monotonic integer nanoseconds for the deadline bookkeeping:
+        # immune to wall-clock jumps and cheaper than float time.time()
+        start = time.monotonic_ns()
+        timeout_ns = int(timeout * 1e9)
+        retries = 0
+        while True:
+            if time.monotonic_ns() - start > timeout_ns:
+                raise TFTPClientError('timeout')
+
+            rto = self._rto(retries)
+
+            txstart = time.monotonic_ns()
+            rxdeadline = txstart + int(rto * 1e9)
+            if connected:
+                if isinstance(tx, tuple):
+                    # (header, payload) pair, gathered in the kernel
+                    sock.sendmsg(tx)
+                else:
+                    sock.send(tx)
+            else:
+                sock.sendto(tx, (self.ip, self.port))
+
+            # keep draining until something useful arrives or the rto
+            # expires, an unusable packet must not trigger an early resend
+            while True:
+                remaining = rxdeadline - time.monotonic_ns()
+                if remaining <= 0 or not self._wait_rx(remaining / 1e9):
+                    retries += 1
+                    break
+
+                try:
+                    # on a connected socket the kernel filters by peer for us
+                    if connected:
+                        nbytes = sock.recv_into(self._rxbuf)
+                        remote = (self.ip, self.port)
+                    else:
+                        nbytes, remote = sock.recvfrom_into(self._rxbuf)
+                except BlockingIOError:
+                    continue
+                rxend = time.monotonic_ns()
+
+                try:
+                    rx = parse_pkt(self._rxview[:nbytes])
+                except (struct.error, ValueError):
+                    logging.exception('parse error')
+                    continue
+                if rx is None or not (connected or remote[0] == self.ip):
+                    continue
+                resp = handle_rx(rx)
+                if resp:
+                    self._update_rtt((rxend - txstart) / 1e9)
+                    return resp, remote
+
+
+    def process_generic_err(self, rx):
+        if rx.op == _OP_ERR:
+            errcode = rx.errcode
+            msg = rx.msg
+            if errcode == Errcode.ACCESS_VIOLATION:
+                raise TFTPClientAccessViolationError(msg)
+            elif errcode == Errcode.CUSTOM:
+                raise TFTPClientCustomError(msg)
+            elif errcode == Errcode.DISK_FULL:
+                raise TFTPClientDiskFullError(msg)
+            elif errcode == Errcode.FILE_NOT_FOUND:
+                raise TFTPClientFileNotFoundError(msg)
+            elif errcode == Errcode.ILLEGAL_OPERATION:
+                raise TFTPClientIllegalOperationError(msg)
+            else:
+                raise TFTPClientError('Server error %s %s' % (str(errcode), msg))
+
+    def process_unhandled(self, rx):
+        raise TFTPClientError('Unexpected packet %s' % str(rx.op))
+
+
+    def handle_read_connect(self, rx):
+        # NOTE: in our implementation custom code most likely means 'busy'.
+        # do not bail out, just retry
+        if rx.op == _OP_ERR and rx.errcode == Errcode.CUSTOM:
+            return None
+
+        self.process_generic_err(rx)
+        if rx.op == _OP_OACK:
+            return rx
+        if rx.op == _OP_DATA:
+            if rx.blocknum == 1:
+                return rx
+            return None
+        self.process_unhandled(rx)
+
+
+    def handle_write_connect(self, rx):
+        if rx.op == _OP_ERR and rx.errcode == Errcode.CUSTOM:
+            return None
+
+        self.process_generic_err(rx)
+        if rx.op == _OP_OACK:
+            return rx
+        if rx.op == _OP_ACK:
+            if rx.acknum == 0:
+                return rx
+            return None
+        self.process_unhandled(rx)
+
+
+    def setup(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # default socket buffers are small enough to drop bursts of
+        # windowed blocks, and every kernel drop costs a retransmit.
+        # the kernel silently caps these to rmem_max/wmem_max
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+        # select-driven waits, recv never blocks
+        self.sock.setblocking(False)
+        # reused for every rx, recvfrom would allocate 2k per packet
+        self._rxbuf = bytearray(2048)
+        self._rxview = memoryview(self._rxbuf)
+        # reused for every ack, create_ack_pkt would allocate per block
+        self._ackbuf = bytearray(4)
+        self.blocknum = 0
+        self.blocksize = 512
+        self.timeout = 1
+        # lock-step until the server grants the rfc7440 windowsize option
+        self.windowsize = 1
+        self.port = self.connect_port
+        self._connected = False
+
+
+    def accept_options(self, oack):
+        try:
+            options = oack.options
+            if 'blksize' in options:
+                bs = int(options['blksize'])
+                if (64 <= bs <= 1468):
+                    self.blocksize = bs
+                else:
+                    raise TFTPClientError('Unacceptable blocksize %d', bs)
+            if 'timeout' in options:
+                tout = int(options['timeout'])
+                if (1 <= tout <= self.session_timeout):
+                    self.timeout = tout
+            if 'windowsize' in options:
+                ws = int(options['windowsize'])
+                if (1 <= ws <= self.def_windowsize):
+                    self.windowsize = ws
+                else:
+                    raise TFTPClientError('Unacceptable windowsize %d' % ws)
+        except TFTPClientError:
+            raise
+        except:
+            raise TFTPClientError('Unacceptable options')
+
+
+    def connect(self, remote):
+        self.sock.connect(remote)
+        self.port = remote[1]
+        self._connected = True
+
+
+    def read(self, filename):
+        self.setup()
+
+        # bytearray grows geometrically, buf += data would copy the whole
+        # received file on every block
+        buf = bytearray()
+
+        pkt = _STRUCT_H.pack(Opcode.RRQ) + cstr(filename) + self._rq_tail
+        resp, remote = self.txrx(pkt, self.handle_read_connect, self.connect_timeout)
+        if resp.op == _OP_OACK:
+            self.accept_options(resp)
+        else: # data
+            self.blocknum = 1
+            buf.extend(resp.data)
+
+        # the response may come from another port. 'connect' to it
+        self.connect(remote)
+
+        if self.windowsize > 1:
+            self._read_windowed(buf)
+            return bytes(buf)
+
+        # keep the block counter in a local, the closure tracks it without
+        # the per-packet attribute traffic of self.blocknum
+        bn = self.blocknum
+
+        def handle_data_rx(rx):
+            self.process_generic_err(rx)
+            if rx.op == _OP_DATA:
+                if rx.blocknum == bn + 1:
+                    return rx
+                return None
+            self.process_unhandled(rx)
+
+        ackbuf = self._ackbuf
+        while True:
+            _STRUCT_HH.pack_into(ackbuf, 0, _OP_ACK, bn)
+            resp,remote = self.txrx(ackbuf, handle_data_rx, self.session_timeout)
+            buf.extend(resp.data)
+            bn += 1
+            self.blocknum = bn
+            if len(resp.data) < self.blocksize:
+                _STRUCT_HH.pack_into(ackbuf, 0, _OP_ACK, bn)
+                self.sock.send(ackbuf)
+                return bytes(buf)
+
+
+    # rfc7440 receive: the server pushes up to windowsize DATA blocks per
+    # ack, we ack the highest in-order block. re-acking it on gap or
+    # timeout rolls the server back (go-back-n)
+    def _read_windowed(self, buf):
+        sock = self.sock
+        ws = self.windowsize
+        bs = self.blocksize
+        bn = self.blocknum
+        if self._mrx is None and _libc is not None:
+            self._mrx = _MmsgReceiver()
+        mrx = self._mrx
+        ackbuf = self._ackbuf
+        session_ns = int(self.session_timeout * 1e9)
+        start = time.monotonic_ns()
+        retries = 0
+        while True:
+            if time.monotonic_ns() - start > session_ns:
+                raise TFTPClientError('timeout')
+
+            _STRUCT_HH.pack_into(ackbuf, 0, _OP_ACK, bn)
+            sock.send(ackbuf)
+
+            rxdeadline = time.monotonic_ns() + int(self._rto(retries) * 1e9)
+            got = 0
+            done = False
+            while got < ws and not done:
+                remaining = rxdeadline - time.monotonic_ns()
+                if remaining <= 0:
+                    break
+                if not self._wait_rx(remaining / 1e9):
+                    break
+                if mrx is not None:
+                    # drain the whole queued burst in one syscall
+                    srcs = mrx.recv(sock)
+                else:
+                    try:
+                        nbytes = sock.recv_into(self._rxbuf)
+                    except BlockingIOError:
+                        continue
+                    srcs = (self._rxview[:nbytes],)
+                for src in srcs:
+                    try:
+                        rx = parse_pkt(src)
+                    except (struct.error, ValueError):
+                        logging.exception('parse error')
+                        continue
+                    if rx is None:
+                        continue
+                    self.process_generic_err(rx)
+                    if rx.op == _OP_DATA:
+                        if rx.blocknum != bn + 1:
+                            # stale or out-of-order block, keep draining: the
+                            # go-back-n resend follows in the same queue
+                            continue
+                        buf.extend(rx.data)
+                        bn += 1
+                        got += 1
+                        if len(rx.data) < bs:
+                            done = True
+                            break
+
+            self.blocknum = bn
+            if done:
+                _STRUCT_HH.pack_into(ackbuf, 0, _OP_ACK, bn)
+                sock.send(ackbuf)
+                return
+            if got:
+                retries = 0
+                start = time.monotonic_ns()
+            else:
+                retries += 1
+
+
+    def write(self, filename, buf):
+        self.setup()
+
+        pkt = _STRUCT_H.pack(Opcode.WRQ) + cstr(filename) + self._rq_tail
+        resp, remote = self.txrx(pkt, self.handle_write_connect, self.connect_timeout)
+        if resp.op == _OP_OACK:
+            self.accept_options(resp)
+
+        self.connect(remote)
+
+        # walk the buffer with a cursor: buf = buf[blocksize:] would copy
+        # the whole remaining tail on every block
+        mv = memoryview(buf)
+
+        if self.windowsize > 1:
+            return self._write_windowed(mv, len(buf))
+
+        offset = 0
+        bn = self.blocknum
+        bs = self.blocksize
+        total = len(buf)
+        # reused header buffer; the payload rides along as a view of the
+        # source, sendmsg gathers the two without a user-space copy
+        hdrbuf = bytearray(4)
+
+        def handle_data_tx(rx):
+            self.process_generic_err(rx)
+            if rx.op == _OP_ACK:
+                if rx.acknum == bn:
+                    return rx
+                return None
+            self.process_unhandled(rx)
+
+        while True:
+            bn += 1
+            self.blocknum = bn
+            chunklen = min(bs, total - offset)
+            _STRUCT_HH.pack_into(hdrbuf, 0, _OP_DATA, bn)
+            tx = (hdrbuf, mv[offset:offset + chunklen])
+            offset += bs
+            resp, remote = self.txrx(tx, handle_data_tx, self.session_timeout)
+
+            if chunklen < bs:
+                return
+
+
+    # rfc7440 send: push a window of DATA blocks, wait for the cumulative
+    # ack, go-back-n from the acked block on timeout. one ack-rtt is
+    # shared by the whole window instead of paid per block
+    def _write_windowed(self, mv, total):
+        sock = self.sock
+        bs = self.blocksize
+        ws = self.windowsize
+        # final block is short (possibly empty) by construction
+        nblocks = total // bs + 1
+        base = 1
+        session_ns = int(self.session_timeout * 1e9)
+        start = time.monotonic_ns()
+        retries = 0
+        while True:
+            if time.monotonic_ns() - start > session_ns:
+                raise TFTPClientError('timeout')
+
+            last = min(base + ws - 1, nblocks)
+            send_data_window(sock, mv, total, bs, base, last)
+
+            txstart = time.monotonic_ns()
+            rxdeadline = txstart + int(self._rto(retries) * 1e9)
+            acked = None
+            while True:
+                remaining = rxdeadline - time.monotonic_ns()
+                if remaining <= 0 or not self._wait_rx(remaining / 1e9):
+                    break
+                try:
+                    nbytes = sock.recv_into(self._rxbuf)
+                except BlockingIOError:
+                    continue
+                try:
+                    rx = parse_pkt(self._rxview[:nbytes])
+                except (struct.error, ValueError):
+                    logging.exception('parse error')
+                    continue
+                if rx is None:
+                    continue
+                self.process_generic_err(rx)
+                if rx.op == _OP_ACK and base <= rx.acknum <= last:
+                    acked = rx.acknum
+                    break
+
+            if acked is None:
+                retries += 1
+                continue
+
+            self._update_rtt((time.monotonic_ns() - txstart) / 1e9)
+            retries = 0
+            start = time.monotonic_ns()
+            self.blocknum = acked
+            if acked == nblocks:
+                return
+            base = acked + 1